@@ -12,12 +12,14 @@ Set an environment variable *OPENAI_API_KEY* or paste the key into the sidebar.
 import json
 import datetime
 import time
+from functools import partial
 from pathlib import Path
 import os
+import uuid
 from dotenv import load_dotenv
 
 import streamlit as st
-from openai import OpenAI
+from openai import APIConnectionError, BadRequestError, DefaultHttpxClient, NotFoundError, OpenAI
 
 # Load environment variables
 load_dotenv()
@@ -36,53 +38,75 @@ CGIAR_GREEN = "#2E7D32"  # primary CGIAR brand colour per 2012 toolkit
 CGIAR_BLUE = "#1A4D8F"   # secondary colour used on cgiar.org
 LOGO_URL = "logo.png"
 
-st.markdown(
-    f"""
+CSS = f"""
     <style>
         /* Hide Streamlit default menu/footer */
         #MainMenu {{visibility: hidden;}}
         footer {{visibility: hidden;}}
 
-        /* Chat bubbles */
-        .chat-bubble {{
-            padding: 0.75rem 1rem;
-            border-radius: 0.75rem;
-            margin-bottom: 0.5rem;
-            line-height: 1.45;
-        }}
-        .user-bubble {{
+        /* CGIAR colours on the native chat messages */
+        [data-testid="stChatMessage"]:has([data-testid="stChatMessageAvatarUser"]) {{
             background-color: {CGIAR_GREEN}20;
             color: {CGIAR_GREEN};
         }}
-        .assistant-bubble {{
+        [data-testid="stChatMessage"]:has([data-testid="stChatMessageAvatarAssistant"]) {{
             background-color: {CGIAR_BLUE}10;
             color: {CGIAR_BLUE};
         }}
     </style>
-    """,
-    unsafe_allow_html=True,
-)
+    """
+
+st.markdown(CSS, unsafe_allow_html=True)
 
 ###############################################################################
 # --- SIDEBAR: SETTINGS ----------------------------------------------------- #
 ###############################################################################
 
+def _build_payload(assistant_id: str, messages: list) -> bytes:
+    """Encode the conversation export; only called when the user downloads."""
+    data = {
+        "assistant_id": assistant_id,
+        "exported_at": datetime.datetime.now(datetime.UTC).isoformat().replace("+00:00", "Z"),
+        "messages": messages,
+    }
+    return json.dumps(data, indent=2).encode("utf-8")
+
+
 with st.sidebar:
     st.image(LOGO_URL, width=160)
     st.header("Settings")
 
     assistant_id = "asst_i9gadw6w4Xd0swmScH5jH4Pv"  # hardcoded ID
     
-    # Download button in sidebar
-    data = {
-        "assistant_id": assistant_id,
-        "exported_at": datetime.datetime.utcnow().isoformat() + "Z",
-        "messages": st.session_state.messages if "messages" in st.session_state else []
-    }
-    json_bytes = json.dumps(data, indent=2).encode("utf-8")
+    # Restore a downloaded conversation; its user turns are replayed into a
+    # fresh thread on the next send
+    uploaded = st.file_uploader("📂 Restore conversation", type="json")
+    if uploaded is not None and st.session_state.get("_restored_file") != uploaded.file_id:
+        st.session_state._restored_file = uploaded.file_id
+        # Ids from the file are not trusted (duplicates would clash as
+        # element keys), so every restored message gets a fresh one
+        try:
+            restored = [
+                {"id": uuid.uuid4().hex, "role": msg["role"], "content": msg["content"]}
+                for msg in json.load(uploaded).get("messages", [])
+            ]
+        except (json.JSONDecodeError, UnicodeDecodeError, AttributeError, KeyError, TypeError):
+            restored = None
+        if restored is None or not all(
+            msg["role"] in ("user", "assistant") and isinstance(msg["content"], str) for msg in restored
+        ):
+            st.error("That file is not a downloaded conversation.")
+        else:
+            st.session_state.messages = restored
+            st.session_state.pop("thread_id", None)
+            st.query_params.pop("t", None)
+            st.session_state._needs_replay = True
+
+    # Download button in sidebar (the payload is only built when clicked)
+    history = st.session_state.messages if "messages" in st.session_state else []
     st.download_button(
         label="💾 Download conversation",
-        data=json_bytes,
+        data=partial(_build_payload, assistant_id, history),
         file_name="chat_history.json",
         mime="application/json",
     )
@@ -91,12 +115,27 @@ with st.sidebar:
 # --- INITIALISE CLIENT & SESSION STATE ------------------------------------ #
 ###############################################################################
 
+@st.cache_resource
+def _make_client(api_key: str) -> OpenAI:
+    """Return the process-wide client for *api_key* so its HTTP/2 connection pool is reused."""
+    return OpenAI(
+        api_key=api_key,
+        timeout=60.0,
+        max_retries=2,
+        http_client=DefaultHttpxClient(http2=True),
+    )
+
+
 def get_client() -> OpenAI | None:
+    """Return the shared client, or None (with an error shown) if no key is set."""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         st.error("Please set the OPENAI_API_KEY environment variable ✨")
         return None
-    return OpenAI(api_key=api_key)
+    return _make_client(api_key)
+
+
+THREAD_SEED_LIMIT = 32  # most messages threads.create accepts in one call
 
 
 def ensure_thread(client: OpenAI, assistant_id: str) -> str:
@@ -104,65 +143,153 @@ def ensure_thread(client: OpenAI, assistant_id: str) -> str:
     if "thread_id" in st.session_state:
         return st.session_state.thread_id
     
-    # Create a new thread
-    thread = client.beta.threads.create()
-    st.session_state.thread_id = thread.id
+    # Only a restored conversation is replayed into the new thread; the
+    # message being sent now (the last one) is posted by call_assistant
+    user_texts = []
+    if st.session_state.pop("_needs_replay", False):
+        user_texts = [msg["content"] for msg in st.session_state.messages[:-1] if msg["role"] == "user"]
     
-    # If we have existing messages, add them to the new thread
-    if "messages" in st.session_state:
-        for msg in st.session_state.messages:
-            if msg["role"] == "user":
-                client.beta.threads.messages.create(
-                    thread_id=thread.id,
-                    role="user",
-                    content=msg["content"]
-                )
+    # Create the thread seeded with the history in one ordered call; any
+    # overflow past the per-call limit is appended one message at a time
+    thread = client.beta.threads.create(
+        messages=[{"role": "user", "content": text} for text in user_texts[:THREAD_SEED_LIMIT]]
+    )
+    for text in user_texts[THREAD_SEED_LIMIT:]:
+        client.beta.threads.messages.create(
+            thread_id=thread.id,
+            role="user",
+            content=text
+        )
+    st.session_state.thread_id = thread.id
+    st.query_params["t"] = thread.id  # lets a reload resume this thread
     
     return thread.id
 
 
+ACTIVE_RUN_STATUSES = {"queued", "in_progress", "requires_action", "cancelling"}
+
+
+def load_thread(client: OpenAI, thread_id: str) -> list | None:
+    """Return the visible history of *thread_id*, or None if it cannot be resumed."""
+    try:
+        client.beta.threads.retrieve(thread_id)
+        # A run still going (a reply cut off by a reload, or another tab on the
+        # same link) would reject the next message, so start afresh instead
+        runs = client.beta.threads.runs.list(thread_id=thread_id, limit=1)
+        if runs.data and runs.data[0].status in ACTIVE_RUN_STATUSES:
+            return None
+        return [
+            {
+                "id": msg.id,
+                "role": msg.role,
+                "content": "".join(part.text.value for part in msg.content if part.type == "text"),
+            }
+            for msg in client.beta.threads.messages.list(thread_id=thread_id, order="asc")
+        ]
+    except (BadRequestError, NotFoundError):  # malformed, deleted or foreign id
+        return None
+
+
 if "messages" not in st.session_state:
-    st.session_state.messages = []  # each item: {"role": "user"|"assistant", "content": str}
+    st.session_state.messages = []  # each item: {"id": str, "role": "user"|"assistant", "content": str}
+
+# Resume the thread named in the URL (?t=...) instead of starting a new one,
+# once per session; an id the API does not know is dropped from the URL
+if "thread_id" not in st.session_state and "t" in st.query_params and (client := get_client()):
+    history = load_thread(client, st.query_params["t"])
+    if history is None:
+        st.query_params.pop("t")
+    else:
+        st.session_state.thread_id = st.query_params["t"]
+        if not st.session_state.messages:
+            st.session_state.messages = history
 
 ###############################################################################
 # --- OPENAI ASSISTANT WRAPPER --------------------------------------------- #
 ###############################################################################
 
-def call_assistant(user_text: str) -> str:
-    """Send *user_text* to the Assistant and return its reply."""
-    client = get_client()
-    if client is None:
-        return ""
-
-    # Ensure a thread exists for this chat session
-    thread_id = ensure_thread(client, assistant_id)
+RUN_TIMEOUT_S = 120  # cancel a run still going after this many seconds
 
-    # Push user message to thread
-    client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=user_text
-    )
 
-    # Run the assistant
-    run = client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=assistant_id,
-    )
-
-    # Poll until completion (with tiny back‑off)
+def wait_for_run(client: OpenAI, thread_id: str, run):
+    """Poll *run* until it finishes, backing off exponentially between polls."""
+    delay = 0.1
+    deadline = time.monotonic() + RUN_TIMEOUT_S
     while run.status not in {"completed", "failed", "cancelled", "expired"}:
-        time.sleep(0.5)
+        if time.monotonic() + delay > deadline:
+            # Cancel so the thread does not stay locked by the abandoned run
+            return client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+        time.sleep(delay)
+        delay = min(delay * 1.6, 1.0)
         run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    return run
+
+
+def call_assistant(user_text: str):
+    """Send *user_text* to the Assistant and yield its reply as text deltas.
+
+    A plain generator over the cached client's event stream, so
+    ``st.write_stream`` renders the reply as it arrives.
+    """
+    client = get_client()
+    if client is None:
+        return
 
-    if run.status != "completed":
-        return f"⚠️ Assistant run ended with status **{run.status}**."
+    # Ensure a thread exists for this chat session
+    thread_id = ensure_thread(client, assistant_id)
 
-    # Fetch all messages and return the latest assistant response
-    messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=1)
-    if messages.data:
-        return messages.data[0].content[0].text.value
-    return "(No assistant response)"
+    # Push user message to thread; the API refuses it while another run on
+    # the thread (e.g. from a second tab on the same link) is still going
+    try:
+        message = client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=user_text
+        )
+    except BadRequestError:
+        yield "⚠️ The assistant is still answering on this conversation; try again once it has finished."
+        return
+
+    # Stream the run so text deltas render as soon as the model emits them
+    streamed = []
+    stream = None
+    try:
+        with client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+        ) as stream:
+            for delta in stream.text_deltas:
+                streamed.append(delta)
+                yield delta
+            run = stream.current_run
+    except APIConnectionError:
+        # The event stream could not be opened or dropped (e.g. a proxy that
+        # buffers SSE): fall back to polling the run it started, if any
+        run = stream.current_run if stream is not None else None
+        if run is None:
+            # The run may have been created before its first event arrived;
+            # only start one if the thread's latest run predates this message
+            runs = client.beta.threads.runs.list(thread_id=thread_id, limit=1)
+            if runs.data and runs.data[0].created_at >= message.created_at:
+                run = runs.data[0]
+        if run is None:
+            run = client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+            )
+        run = wait_for_run(client, thread_id, run)
+        if run.status == "completed":
+            messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=1)
+            if messages.data:
+                # Only emit what the dropped stream had not delivered yet
+                text = messages.data[0].content[0].text.value[len("".join(streamed)):]
+                streamed.append(text)
+                yield text
+
+    if run is None or run.status != "completed":
+        yield f"⚠️ Assistant run ended with status **{run.status if run else 'unknown'}**."
+    elif not streamed:
+        yield "(No assistant response)"
 
 ###############################################################################
 # --- MAIN CHAT UI ---------------------------------------------------------- #
@@ -172,32 +299,40 @@ st.title("Type 2 Report Assistant")
 
 chat_placeholder = st.container()
 
+# Index of the first message not yet drawn in this script run. Streamlit
+# drops any element a run doesn't re-emit, so it restarts at zero each rerun.
+st.session_state.rendered_upto = 0
+
+
+def render_pending_messages():
+    """Draw the messages appended since the last call in this run."""
+    for msg in st.session_state.messages[st.session_state.rendered_upto:]:
+        with chat_placeholder.container(key=f"msg-{msg['id']}"), st.chat_message(msg["role"]):
+            st.markdown(msg["content"])
+        st.session_state.rendered_upto += 1
+
+
 # Display previous messages
-for msg in st.session_state.messages:
-    bubble_class = "user-bubble" if msg["role"] == "user" else "assistant-bubble"
-    chat_placeholder.markdown(
-        f'<div class="chat-bubble {bubble_class}"><b>{"You" if msg["role"]=="user" else "Assistant"}:</b> {msg["content"]}</div>',
-        unsafe_allow_html=True,
-    )
+render_pending_messages()
 
 # Chat input (uses Streamlit 1.27+)
 user_input = st.chat_input("Type your message and press Enter…")
 
 if user_input:
     # 1️⃣  Add user message to local history
-    st.session_state.messages.append({"role": "user", "content": user_input})
-    chat_placeholder.markdown(
-        f'<div class="chat-bubble user-bubble"><b>You:</b> {user_input}</div>',
-        unsafe_allow_html=True,
-    )
+    st.session_state.messages.append({"id": uuid.uuid4().hex, "role": "user", "content": user_input})
+    render_pending_messages()
 
     # 2️⃣  Call assistant and stream response token by token
-    with st.spinner("Assistant is composing a reply…"):
-        assistant_reply = call_assistant(user_input)
+    # into a container keyed by the id it will be stored under
+    reply_id = uuid.uuid4().hex
+    with (
+        st.spinner("Assistant is composing a reply…"),
+        chat_placeholder.container(key=f"msg-{reply_id}"),
+        st.chat_message("assistant"),
+    ):
+        assistant_reply = st.write_stream(call_assistant(user_input))
 
     # 3️⃣  Add assistant reply to history
-    st.session_state.messages.append({"role": "assistant", "content": assistant_reply})
-    chat_placeholder.markdown(
-        f'<div class="chat-bubble assistant-bubble"><b>Assistant:</b> {assistant_reply}</div>',
-        unsafe_allow_html=True,
-    )
+    st.session_state.messages.append({"id": reply_id, "role": "assistant", "content": assistant_reply})
+    st.session_state.rendered_upto += 1  # already drawn by st.write_stream